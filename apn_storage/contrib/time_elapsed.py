@@ -1,22 +1,34 @@
+import os
 import sys
-import time
+import timeit
 
 from contextlib import contextmanager
 
 
+# Timing is only performed when this environment variable is set, so that
+# time_elapsed blocks can be left in code without any output or overhead.
+ENABLED = os.environ.get('TIME_ELAPSED_ENABLED') == '1'
+
+
 @contextmanager
 def time_elapsed(name=''):
     """
     A context manager for timing blocks of code.
     From https://gist.github.com/raymondbutcher/5168588
 
+    Set the TIME_ELAPSED_ENABLED=1 environment variable to enable it.
+
     """
-    start = time.time()
+    if not ENABLED:
+        yield
+        return
+    start = timeit.default_timer()
     yield
-    elapsed = (time.time() - start) * 1000
-    if name:
-        sys.stderr.write('%s took ' % name)
+    elapsed = (timeit.default_timer() - start) * 1000
     if elapsed < 1:
-        sys.stderr.write('%.4f ms\n' % elapsed)
+        message = '%.4f ms\n' % elapsed
     else:
-        sys.stderr.write('%d ms\n' % elapsed)
+        message = '%d ms\n' % elapsed
+    if name:
+        message = '%s took %s' % (name, message)
+    sys.stderr.write(message)
@@ -1,8 +1,9 @@
 """
 A tool for generating unique ID strings.
 
-Uses a BSON Object ID for the underlying unique value generation.
-See http://stackoverflow.com/a/5694803/2835599 for an explanation of "unique".
+Uses the current time in microseconds combined with a per-process counter
+for the underlying unique value generation. The counter starts at a random
+number, so separate processes and machines are unlikely to overlap.
 
 The class accepts an alphabet to use for the final string. This affects which
 characters will be seen in the resulting UID strings, and also how long the
@@ -16,21 +17,54 @@ Usage:
     from apn_storage import uid
     uid.alphanumeric()
 
-Currently requires pymongo and NOT bson, because pymongo
+Generators can instead use a BSON Object ID for the unique value by passing
+use_bson=True. See http://stackoverflow.com/a/5694803/2835599 for an
+explanation of "unique". That requires pymongo and NOT bson, because pymongo
 includes a different version of the bson module. I think.
 
 """
 
-import bson
+import itertools
+import os
 import string
+import struct
+import sys
+import threading
+import time
+
+
+# The number of bits in the unique values being encoded.
+UNIQUE_BITS = 96
+
+_counter = None
+_counter_pid = None
+_counter_lock = threading.Lock()
+
+
+def _unique_int():
+    """
+    Generate a unique integer from the current time and a counter.
+    The counter is reseeded after forking, so that child processes
+    don't continue the same sequence as their parent.
+
+    """
+    global _counter, _counter_pid
+    if _counter_pid != os.getpid():
+        with _counter_lock:
+            if _counter_pid != os.getpid():
+                seed, = struct.unpack('>I', os.urandom(4))
+                _counter = itertools.count(seed)
+                _counter_pid = os.getpid()
+    return (int(time.time() * 1000000) << 32) | (next(_counter) & 0xFFFFFFFF)
 
 
 class UIDGenerator(object):
 
-    def __init__(self, alphabet):
+    def __init__(self, alphabet, use_bson=False):
         """Create a new UID generator using the provided alphabet."""
 
         self.alphabet = str(alphabet)
+        self.use_bson = use_bson
 
         self._alphabet_length = len(alphabet)
         if self._alphabet_length < 2:
@@ -39,22 +73,83 @@ class UIDGenerator(object):
         if len(set(self.alphabet)) != self._alphabet_length:
             raise ValueError('The alphabet contained duplicate characters.')
 
+        # Generated strings are padded to the number of characters needed
+        # for the largest possible value, so they always have this length.
+        self.length = 1
+        while self._alphabet_length ** self.length < 2 ** UNIQUE_BITS:
+            self.length += 1
+
+        # Output is built in a bytearray, so keep the alphabet as byte values.
+        self._alphabet_bytes = bytearray(self.alphabet)
+
+        # When the alphabet length is a power of two, each character
+        # represents a fixed number of bits, so the digits can be extracted
+        # with masks and shifts instead of big integer division.
+        if self._alphabet_length & (self._alphabet_length - 1) == 0:
+            self._bits = self._alphabet_length.bit_length() - 1
+        else:
+            self._bits = 0
+
+            # Otherwise, produce two characters per division by looking up
+            # pairs of digits in a table. Digits are generated from least
+            # to most significant, so each pair is stored in that order.
+            self._base_squared = self._alphabet_length ** 2
+            self._pair_table = [
+                self.alphabet[index % self._alphabet_length] + self.alphabet[index // self._alphabet_length]
+                for index in xrange(self._base_squared)
+            ]
+
+            # Unique values are too large for native integers, so division
+            # uses slower long integers. Split values into a low part that
+            # is small enough to be a native integer, and a high part.
+            self._limb_pairs = 1
+            while self._base_squared ** (self._limb_pairs + 1) <= sys.maxint:
+                self._limb_pairs += 1
+            self._limb_base = self._base_squared ** self._limb_pairs
+
     def __call__(self):
         """Generate a new unique string."""
-        unique_hex = str(bson.ObjectId())
-        unique_int = int(unique_hex, 16)
-        output = ''
-        while unique_int:
-            unique_int, index = divmod(unique_int, self._alphabet_length)
-            output += self.alphabet[index]
-        return output
-
-    @property
-    def length(self):
-        """The length of generated strings."""
-        if not hasattr(self, '_length'):
-            self._length = len(self())
-        return self._length
+
+        if self.use_bson:
+            # Read the 12 byte ObjectId as a 96 bit integer.
+            import bson
+            high, low = struct.unpack('>IQ', bson.ObjectId().binary)
+            unique_int = (high << 64) | low
+        else:
+            unique_int = _unique_int()
+
+        alphabet = self._alphabet_bytes
+        output = bytearray()
+        append = output.append
+
+        if self._bits:
+            bits = self._bits
+            mask = self._alphabet_length - 1
+            while unique_int:
+                append(alphabet[unique_int & mask])
+                unique_int >>= bits
+        else:
+            base_squared = self._base_squared
+            pair_table = self._pair_table
+            extend = output.extend
+            high, low = divmod(unique_int, self._limb_base)
+            for x in xrange(self._limb_pairs):
+                low, pair_index = divmod(low, base_squared)
+                extend(pair_table[pair_index])
+            while high:
+                high, pair_index = divmod(high, base_squared)
+                extend(pair_table[pair_index])
+
+        # Pad with zeros to the fixed length. Digits are in reverse order,
+        # so leading zeros go on the end. The pair encoding can also
+        # produce one leading zero too many, so trim that off.
+        padding = self.length - len(output)
+        if padding > 0:
+            output.extend(alphabet[:1] * padding)
+        elif padding < 0:
+            del output[padding:]
+
+        return str(output)
 
 
 alphanumeric = UIDGenerator(string.digits + string.ascii_letters)
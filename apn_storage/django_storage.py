@@ -1,5 +1,6 @@
 import os
 import re
+import stat
 
 from django.core.files import File
 from django.template.defaultfilters import slugify
@@ -9,6 +10,12 @@ from fs.expose import django_storage
 from fs.path import dirname
 
 from apn_storage.contrib import uid
+from apn_storage.utils import memoize
+
+
+# Compiled UID suffix patterns, keyed by (alphabet, length). These are shared
+# between storage instances because compiling the character class is slow.
+_SUFFIX_RE_CACHE = {}
 
 
 class FSStorage(django_storage.FSStorage):
@@ -28,10 +35,24 @@ class FSStorage(django_storage.FSStorage):
         # and avoids race conditions. Create a regular expression here
         # for matching those UID suffixes.
         self._uid_generator = uid.alphanumeric_lowercase
-        self._uid_suffix_re = re.compile('-[%s]{%d}$' % (
-            self._uid_generator.alphabet,
-            self._uid_generator.length,
-        ))
+        key = (self._uid_generator.alphabet, self._uid_generator.length)
+        self._uid_regex_fragment = '[%s]{%d}' % key
+        self._uid_suffix_re = _SUFFIX_RE_CACHE.get(key)
+        if self._uid_suffix_re is None:
+            self._uid_suffix_re = re.compile('-%s$' % self._uid_regex_fragment)
+            _SUFFIX_RE_CACHE[key] = self._uid_suffix_re
+
+        # Most filenames won't have a UID suffix, so get_available_name
+        # checks for one with simple string operations instead of the regex.
+        self._uid_alphabet_set = frozenset(self._uid_generator.alphabet)
+
+    def _remove_uid_suffix(self, filename):
+        """Remove a UID suffix from the filename, if it has one."""
+        length = self._uid_generator.length
+        if len(filename) > length and filename[-length - 1] == '-':
+            if self._uid_alphabet_set.issuperset(filename[-length:]):
+                return filename[:-length - 1]
+        return filename
 
     @convert_fs_errors
     def _open(self, name, mode):
@@ -41,8 +62,10 @@ class FSStorage(django_storage.FSStorage):
     @convert_fs_errors
     def _save(self, name, content):
         self.fs.makedir(dirname(name), allow_recreate=True, recursive=True)
-        if hasattr(content, 'seek'):
+        if hasattr(content, 'seek') and content.tell() != 0:
             content.seek(0)
+        # Pass the file object rather than its contents, so that it gets
+        # streamed in chunks instead of being read into memory.
         self.fs.setcontents(name, content)
         return name
 
@@ -84,11 +107,11 @@ class FSStorage(django_storage.FSStorage):
             extension += '.gz'
 
         # Remove existing UUID suffixes from filenames.
-        filename = self._uid_suffix_re.sub('', filename)
+        filename = self._remove_uid_suffix(filename)
 
         # Clean up the filename and append a UUID to it.
         filename = '%s-%s' % (
-            slugify(filename).encode('ascii'),
+            cached_slugify(filename),
             self._uid_generator(),
         )
 
@@ -109,18 +132,26 @@ class FSStorage(django_storage.FSStorage):
 
         # Clean up the filename and append a UUID to it.
         filename = '%s-%s' % (
-            slugify(filename).encode('ascii'),
-            '[%s]{%d}' % (self._uid_generator.alphabet, self._uid_generator.length)
+            cached_slugify(filename),
+            self._uid_regex_fragment,
         )
 
         return os.path.join(directory, filename + extension)
 
     @convert_fs_errors
     def listdir(self, path):
-        """Use ilistdir to optimize the isdir checks."""
+        """
+        Use ilistdirinfo to avoid isdir checks. Most filesystems include
+        st_mode in the info dicts, otherwise fall back to checking isdir.
+
+        """
         directories, files = [], []
-        for entry in self.fs.ilistdir(path):
-            if self.fs.isdir(os.path.join(path, entry)):
+        for entry, info in self.fs.ilistdirinfo(path):
+            if 'st_mode' in info:
+                is_dir = stat.S_ISDIR(info['st_mode'])
+            else:
+                is_dir = self.fs.isdir(os.path.join(path, entry))
+            if is_dir:
                 directories.append(entry)
             else:
                 files.append(entry)
@@ -131,6 +162,16 @@ class FSStorage(django_storage.FSStorage):
         raise NotImplementedError
 
 
+@memoize(max_size=2048)
+def cached_slugify(value):
+    """
+    Slugify a value, using a cache because slugify is fairly slow and the
+    same filenames are often uploaded repeatedly.
+
+    """
+    return slugify(value)
+
+
 class FSStorageFile(File):
 
     def __init__(self, file, storage, name):
@@ -138,9 +179,11 @@ class FSStorageFile(File):
         self.storage = storage
         self.name = name
         self.mode = getattr(file, 'mode', None)
+        # The size is looked up from the storage when first accessed.
+        self._size = None
 
     def _get_size(self):
-        if not hasattr(self, '_size'):
+        if self._size is None:
             self._size = self.storage.size(self.name)
         return self._size
 
@@ -1,15 +1,21 @@
 import datetime
 import logging
 import requests
+import tempfile
+import threading
 import time
 
 from django.utils.http import urlquote
 
-from email.Utils import parsedate
+from email.utils import parsedate
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 from fs.base import FS
 from fs.errors import RemoteConnectionError, ResourceNotFoundError, UnsupportedError
-from fs.filelike import StringIO
+
+from apn_storage.utils import memoize
 
 
 class HTTPFS(FS):
@@ -23,27 +29,39 @@ class HTTPFS(FS):
         'unicode_paths': False,
     }
 
-    def __init__(self, base_url, cache_time=30):
+    def __init__(self, base_url, cache_time=30, error_cache_time=5, cache_size=10000):
         super(HTTPFS, self).__init__()
         self._base_url = base_url.rstrip('/')
-        self._cache_time = cache_time
-        self._info_cache = {}
+        # Successful lookups and errors are cached separately, so that a
+        # burst of missing files can't push out the info for real files.
+        self._info_cache = TTLCache(maxsize=cache_size, ttl=cache_time)
+        self._error_cache = TTLCache(maxsize=cache_size // 10, ttl=error_cache_time)
+
+        # Use a session to reuse connections between requests. The adapter
+        # retries connection errors and server errors a few times.
+        adapter = HTTPAdapter(
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.1, status_forcelist=(500, 502, 503, 504)),
+        )
+        self._session = requests.Session()
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def close(self):
+        self._session.close()
+        super(HTTPFS, self).close()
 
     def _build_url(self, path):
-        return '%s/%s' % (self._base_url, urlquote(path))
+        return '%s/%s' % (self._base_url, quote_path(path))
 
     def _getinfo(self, path):
 
         url = self._build_url(path)
 
-        for attempt in (1, 2, 3):
-            try:
-                response = requests.head(url)
-            except requests.RequestException as error:
-                logging.warning('getinfo attempt %d: %s %s' % (attempt, url, error))
-            else:
-                break
-        else:
+        try:
+            response = self._session.head(url, timeout=(3, 10))
+        except requests.RequestException as error:
+            logging.warning('getinfo failed: %s %s' % (url, error))
             raise RemoteConnectionError('getinfo', path)
 
         if response.status_code == 200:
@@ -71,30 +89,23 @@ class HTTPFS(FS):
 
     def getinfo(self, path):
 
-        cached = self._info_cache.get(path)
-        if cached:
-            expires, info, error = cached
-            if expires > time.time():
-                if error:
-                    raise error
-                else:
-                    return info
-
         try:
+            return self._info_cache[path]
+        except KeyError:
+            pass
 
-            info = None
-            error = None
+        error = self._error_cache.get(path)
+        if error is not None:
+            raise error
 
-            try:
-                info = self._getinfo(path)
-                return info
-            except Exception as exception:
-                error = exception
-                raise
+        try:
+            info = self._getinfo(path)
+        except Exception as error:
+            self._error_cache[path] = error
+            raise
 
-        finally:
-            expires = time.time() + self._cache_time
-            self._info_cache[path] = (expires, info, error)
+        self._info_cache[path] = info
+        return info
 
     def isfile(self, path):
         try:
@@ -115,30 +126,95 @@ class HTTPFS(FS):
 
         url = self._build_url(path)
 
-        for attempt in (1, 2, 3):
-            try:
-                response = requests.get(url)
-            except requests.RequestException as error:
-                logging.warning('open attempt %d: %s %s' % (attempt, url, error))
+        try:
+            response = self._session.get(url, stream=True, timeout=(3, 60))
+        except requests.RequestException as error:
+            logging.warning('open failed: %s %s' % (url, error))
+            raise RemoteConnectionError('open', path)
+
+        try:
+            if response.status_code == 200:
+                # Download the file in chunks. Small files stay in memory,
+                # larger files are written to a temporary file on disk.
+                open_file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+                try:
+                    for chunk in response.iter_content(64 * 1024):
+                        open_file.write(chunk)
+                except requests.RequestException as error:
+                    open_file.close()
+                    logging.warning('open failed: %s %s' % (url, error))
+                    raise RemoteConnectionError('open', path)
+                open_file.seek(0)
+                return open_file
+            elif response.status_code == 404:
+                raise ResourceNotFoundError(path)
             else:
-                break
-        else:
-            raise RemoteConnectionError('getinfo', path)
+                logging.warning('open status %d for %s assumed as connection error.' % (response.status_code, url))
+                raise RemoteConnectionError('open', path)
+        finally:
+            response.close()
 
-        if response.status_code == 200:
-            return StringIO(response.content)
-        elif response.status_code == 404:
-            raise ResourceNotFoundError(path)
-        else:
-            logging.warning('open status %d for %s assumed as connection error.' % (response.status_code, url))
-            raise RemoteConnectionError('open', path)
 
+class TTLCache(object):
+    """
+    A size limited cache where items expire after ttl seconds.
+
+    When the cache is full, expired items are purged. If that does not free
+    up enough space, then the whole cache is cleared. This is simpler than
+    tracking the least recently used item, and is fine for a cache that
+    should rarely fill up.
+
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        expires, value = self._items[key]
+        if expires <= time.time():
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            if len(self._items) >= self.maxsize and key not in self._items:
+                now = time.time()
+                for item_key, (expires, item_value) in self._items.items():
+                    if expires <= now:
+                        del self._items[item_key]
+                if len(self._items) >= self.maxsize:
+                    self._items.clear()
+            self._items[key] = (time.time() + self.ttl, value)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+@memoize(max_size=4096)
+def quote_path(path):
+    """
+    URL quote a path. Results are cached because getinfo and open are
+    usually called with the same paths, and quoting is deterministic.
 
+    """
+    return urlquote(path)
+
+
+@memoize(max_size=1024)
 def parse_http_date(date_string):
     """
     Converts a HTTP datetime string into a Python datatime object.
     Doesn't support every single format, but it's good enough.
 
+    Results are cached because parsing is slow, and the same
+    Last-Modified values are seen repeatedly.
+
     """
     try:
         return datetime.datetime(*parsedate(date_string)[:6])
@@ -70,9 +70,13 @@ class MultiFS(multifs.MultiFS):
 
     @synchronize
     def getinfo(self, path):
+        # Call getinfo directly rather than checking exists first,
+        # which would be an extra round trip for remote filesystems.
         for fs in self:
-            if fs.exists(path):
+            try:
                 return fs.getinfo(path)
+            except ResourceNotFoundError:
+                pass
         raise ResourceNotFoundError(path)
 
     @synchronize
@@ -86,13 +90,45 @@ class MultiFS(multifs.MultiFS):
 
     @synchronize
     def ilistdir(self, path='./', *args, **kwargs):
+        if len(self.fs_sequence) == 1:
+            # There is nothing to deduplicate with a single layer.
+            try:
+                for fs_path in self.fs_sequence[0].ilistdir(path, *args, **kwargs):
+                    yield fs_path
+            except FSError:
+                pass
+            return
         seen_paths = set()
+        seen_path = seen_paths.__contains__
+        add_seen_path = seen_paths.add
         for fs in self:
             try:
                 for fs_path in fs.ilistdir(path, *args, **kwargs):
-                    if fs_path not in seen_paths:
+                    if not seen_path(fs_path):
+                        add_seen_path(fs_path)
                         yield fs_path
-                        seen_paths.add(fs_path)
+            except FSError:
+                pass
+
+    @synchronize
+    def ilistdirinfo(self, path='./', *args, **kwargs):
+        if len(self.fs_sequence) == 1:
+            # There is nothing to deduplicate with a single layer.
+            try:
+                for entry in self.fs_sequence[0].ilistdirinfo(path, *args, **kwargs):
+                    yield entry
+            except FSError:
+                pass
+            return
+        seen_paths = set()
+        seen_path = seen_paths.__contains__
+        add_seen_path = seen_paths.add
+        for fs in self:
+            try:
+                for entry in fs.ilistdirinfo(path, *args, **kwargs):
+                    if not seen_path(entry[0]):
+                        add_seen_path(entry[0])
+                        yield entry
             except FSError:
                 pass
 
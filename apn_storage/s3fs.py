@@ -1,9 +1,16 @@
-import os
+import mimetypes
+import posixpath
+import time
 
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from boto.s3.multipart import MultiPartUpload
 from boto.s3.prefix import Prefix
 
 from fs import s3fs
 from fs.errors import ResourceInvalidError, ResourceNotFoundError
+from fs.path import normpath, relpath
 from fs.wrapfs.subfs import SubFS
 
 from lazyobject import ThreadSafeLazyObject
@@ -13,10 +20,26 @@ class S3FS(s3fs.S3FS):
     """
     Extended to support boto's preferred way of reading credentials
     from a configuration file. Also, there is an ilistdir() optimization
-    that allows checking isdir() and isfile() without hitting S3 again.
+    that allows checking isdir() and isfile() without hitting S3 again,
+    and a prefetch() method to do the same for many sibling paths.
+
+    Large files are uploaded in parts by a pool of threads, while the
+    next part is being read from the source file, and removemany() deletes
+    files in batches.
 
     """
 
+    # Returned by _prefetched_is_dir when the path was not prefetched.
+    _NOT_PREFETCHED = object()
+
+    # Files of at least this size are uploaded in parts. S3 requires
+    # all parts except the last to be at least 5 MiB.
+    multipart_size = 8 * 1024 * 1024
+    multipart_threads = 4
+
+    # S3 accepts up to 1000 keys in one multi-object delete request.
+    delete_batch_size = 1000
+
     def __init__(self, *args, **kwargs):
 
         # Use some dummy values to avoid the validation in the init method.
@@ -36,6 +59,82 @@ class S3FS(s3fs.S3FS):
             setattr(self._tlocal, 'is_dir_dict', {})
         return getattr(self._tlocal, 'is_dir_dict')
 
+    @property
+    def _prefetched_dirs(self):
+        # Use threadlocals to remember the contents of prefetched directories.
+        # This maps directory paths to (expires, {name: is_dir}) tuples.
+        if not hasattr(self._tlocal, 'prefetched_dirs'):
+            setattr(self._tlocal, 'prefetched_dirs', {})
+        return getattr(self._tlocal, 'prefetched_dirs')
+
+    def prefetch(self, paths, cache_time=10):
+        """
+        List the parent directories of the given paths with one request
+        per directory, so that isdir() and isfile() checks for anything in
+        those directories can be answered without more requests. This is
+        much faster than checking many sibling files individually.
+
+        The results are only remembered by the current thread, and only for
+        cache_time seconds, so call this just before performing the checks.
+        Paths missing from a listing are still checked with S3, and listings
+        are forgotten when files or directories in them are changed.
+
+        """
+        prefetched_dirs = self._prefetched_dirs
+        now = time.time()
+        for parent in set(posixpath.dirname(relpath(normpath(path))) for path in paths):
+            expires, entries = prefetched_dirs.get(parent, (0, None))
+            if expires > now:
+                continue
+            entries = {}
+            try:
+                for name, key in self._iter_keys(parent):
+                    entries[name] = key.__class__ is Prefix
+            except (ResourceInvalidError, ResourceNotFoundError):
+                pass
+            prefetched_dirs[parent] = (now + cache_time, entries)
+
+    def _prefetched_is_dir(self, path):
+        """
+        Check the prefetched directories for a path. Returns True for
+        directories and False for files. Paths that are missing from the
+        listing could have been created since it was fetched, so they
+        return _NOT_PREFETCHED, the same as paths that weren't prefetched.
+
+        """
+        if path.endswith('/'):
+            return self._NOT_PREFETCHED
+        path = relpath(normpath(path))
+        if not path:
+            # The root directory is not in any listing.
+            return self._NOT_PREFETCHED
+        parent, name = posixpath.split(path)
+        expires, entries = self._prefetched_dirs.get(parent, (0, None))
+        if expires <= time.time():
+            return self._NOT_PREFETCHED
+        return entries.get(name, self._NOT_PREFETCHED)
+
+    def _forget_prefetched(self, *paths):
+        """
+        Forget the prefetched listings that could include the given paths,
+        or anything inside them. This is called by the methods that change
+        files and directories, so that the listings don't give old answers.
+
+        """
+        prefetched_dirs = self._prefetched_dirs
+        if not prefetched_dirs:
+            return
+        for path in paths:
+            path = relpath(normpath(path))
+            if not path:
+                prefetched_dirs.clear()
+                return
+            prefetched_dirs.pop(posixpath.dirname(path), None)
+            prefix = path + '/'
+            for parent in prefetched_dirs.keys():
+                if parent == path or parent.startswith(prefix):
+                    del prefetched_dirs[parent]
+
     def _iter_keys(self, path):
         """
         Iterator over keys contained in the given directory.
@@ -57,24 +156,35 @@ class S3FS(s3fs.S3FS):
 
         isDir = False
 
+        # Bind everything used in the loop to locals, because
+        # this can iterate over thousands of keys.
+        separator = self._separator
+        uns3path = self._uns3path
+        if not path or path.endswith('/'):
+            path_prefix = path
+        else:
+            path_prefix = path + '/'
+
         is_dir_dict = self._is_dir_dict
+        set_is_dir = is_dir_dict.__setitem__
         try:
-            for k in self._s3bukt.list(prefix=s3path, delimiter=self._separator):
+            for k in self._s3bukt.list(prefix=s3path, delimiter=separator):
 
                 if not isDir:
                     isDir = True
 
                 # Skip over the entry for the directory itself, if it exists
-                name = self._uns3path(k.name, s3path)
+                name = uns3path(k.name, s3path)
                 if name != "":
 
                     if not isinstance(name, unicode):
                         name = name.decode("utf8")
-                    if name.endswith(self._separator):
+                    if name.endswith(separator):
                         name = name[:-1]
 
                     # Record whether this path is a directory or not.
-                    is_dir_dict[os.path.join(path, name)] = isinstance(k, Prefix)
+                    # This is the same as os.path.join(path, name).
+                    set_is_dir(path_prefix + name, k.__class__ is Prefix)
 
                     yield (name, k)
         finally:
@@ -89,27 +199,188 @@ class S3FS(s3fs.S3FS):
                     raise ResourceInvalidError(path, msg=msg)
                 raise ResourceNotFoundError(path)
 
-    def copy(self, *args, **kwargs):
+    def copy(self, src, dst, *args, **kwargs):
         # Override this because it raises the wrong exception
         # when the source file does not exist.
         try:
-            return super(S3FS, self).copy(*args, **kwargs)
+            return super(S3FS, self).copy(src, dst, *args, **kwargs)
         except ResourceInvalidError as error:
             raise ResourceNotFoundError(error.path)
+        finally:
+            self._forget_prefetched(dst)
+
+    def makedir(self, path, recursive=False, allow_recreate=False):
+        try:
+            return super(S3FS, self).makedir(path, recursive=recursive, allow_recreate=allow_recreate)
+        finally:
+            self._forget_prefetched(path)
+
+    def removedir(self, path, recursive=False, force=False):
+        try:
+            return super(S3FS, self).removedir(path, recursive=recursive, force=force)
+        finally:
+            self._forget_prefetched(path)
+
+    def rename(self, src, dst):
+        try:
+            return super(S3FS, self).rename(src, dst)
+        finally:
+            self._forget_prefetched(src, dst)
+
+    def move(self, src, dst, overwrite=False, chunk_size=16384):
+        try:
+            return super(S3FS, self).move(src, dst, overwrite=overwrite, chunk_size=chunk_size)
+        finally:
+            self._forget_prefetched(src, dst)
+
+    def remove(self, path, wait=True):
+        """
+        Remove the file at the given path. By default, this polls S3 until
+        the file is no longer returned. Use wait=False to skip that when
+        nothing will look for the file straight after it is removed.
+
+        """
+        try:
+            return self._remove(path, wait)
+        finally:
+            self._forget_prefetched(path)
+
+    def _remove(self, path, wait):
+        if wait:
+            return super(S3FS, self).remove(path)
+        s3path = self._s3path(path)
+        for k in self._s3bukt.list(prefix=s3path, delimiter=self._separator):
+            if s3fs._eq_utf8(k.name, s3path):
+                break
+            if s3fs._startswith_utf8(k.name, s3path + '/'):
+                msg = "that's not a file: %(path)s"
+                raise ResourceInvalidError(path, msg=msg)
+        else:
+            raise ResourceNotFoundError(path)
+        self._s3bukt.delete_key(s3path)
+
+    def removemany(self, paths):
+        """
+        Remove many files with one request per batch of files, rather than
+        one request per file. Unlike remove(), this does not check that each
+        path is a file, nor wait for the deletions to become visible.
+
+        Returns the paths that were deleted, in their original order.
+
+        """
+        self._forget_prefetched(*paths)
+        deleted = set()
+        for start in xrange(0, len(paths), self.delete_batch_size):
+            batch = [self._s3path(path) for path in paths[start:start + self.delete_batch_size]]
+            result = self._s3bukt.delete_keys(batch)
+            for key in result.deleted:
+                name = key.key
+                if isinstance(name, unicode):
+                    name = name.encode('utf8')
+                deleted.add(name)
+        return [path for path in paths if self._s3path(path) in deleted]
+
+    def setcontents(self, path, data=b'', encoding=None, errors=None, chunk_size=64 * 1024):
+        try:
+            return self._setcontents(path, data, encoding=encoding, errors=errors, chunk_size=chunk_size)
+        finally:
+            self._forget_prefetched(path)
+
+    def _setcontents(self, path, data, encoding, errors, chunk_size):
+        if hasattr(data, 'read') and self._key_sync_timeout is None:
+            # Upload the whole file, as boto does, whatever its position.
+            try:
+                data.seek(0)
+            except (AttributeError, EnvironmentError):
+                pass
+            first_part = self._read_part(data)
+            if len(first_part) == self.multipart_size:
+                content_type = mimetypes.guess_type(getattr(data, 'name', None) or path)[0]
+                headers = {'Content-Type': content_type or 'application/octet-stream'}
+                return self._multipart_upload(self._s3path(path), first_part, data, headers)
+            # Upload the original file object rather than the bytes read
+            # from it, because boto uses its name to set the Content-Type.
+            try:
+                data.seek(0)
+            except (AttributeError, EnvironmentError):
+                data = first_part
+        return super(S3FS, self).setcontents(path, data, encoding=encoding, errors=errors, chunk_size=chunk_size)
+
+    def _multipart_upload(self, s3path, first_part, data, headers=None):
+        """
+        Upload a file in parts. Parts are uploaded by a pool of threads,
+        while the main thread reads the following parts from the file.
+        This overlaps reading with uploading, and uploads several parts at
+        once. The number of parts held in memory is limited by waiting for
+        older uploads to finish before reading more.
+
+        """
+        upload = self._s3bukt.initiate_multipart_upload(s3path, headers=headers)
+        pool = ThreadPool(self.multipart_threads)
+        try:
+            results = []
+            part = first_part
+            while part:
+                if len(results) >= self.multipart_threads:
+                    results[-self.multipart_threads].get()
+                results.append(pool.apply_async(self._upload_part, (upload.id, s3path, len(results) + 1, part)))
+                part = self._read_part(data)
+            for result in results:
+                result.get()
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+        finally:
+            pool.terminate()
+
+    def _read_part(self, data):
+        """
+        Read a part of multipart_size bytes from a file, or less at the end
+        of the file. A read can return less than was asked for before the
+        end, and S3 rejects parts smaller than 5 MiB other than the last,
+        so this keeps reading until the part is full or a read returns
+        nothing.
+
+        """
+        part = data.read(self.multipart_size)
+        if not part or len(part) == self.multipart_size:
+            return part
+        chunks = [part]
+        size = len(part)
+        while size < self.multipart_size:
+            chunk = data.read(self.multipart_size - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        return b''.join(chunks)
+
+    def _upload_part(self, upload_id, s3path, part_num, part):
+        # Connections are not shared between threads, so create
+        # the upload object using this thread's bucket object.
+        upload = MultiPartUpload(self._s3bukt)
+        upload.id = upload_id
+        upload.key_name = s3path
+        upload.upload_part_from_file(StringIO(part), part_num)
 
     def isdir(self, path):
         is_dir_dict = self._is_dir_dict
         if path in is_dir_dict:
             return is_dir_dict[path]
-        else:
-            return super(S3FS, self).isdir(path)
+        is_dir = self._prefetched_is_dir(path)
+        if is_dir is not self._NOT_PREFETCHED:
+            return is_dir is True
+        return super(S3FS, self).isdir(path)
 
     def isfile(self, path):
         is_dir_dict = self._is_dir_dict
         if path in is_dir_dict:
             return not is_dir_dict[path]
-        else:
-            return super(S3FS, self).isfile(path)
+        is_dir = self._prefetched_is_dir(path)
+        if is_dir is not self._NOT_PREFETCHED:
+            return is_dir is False
+        return super(S3FS, self).isfile(path)
 
     def opendir(self, path):
         return self._sub_fs(path)
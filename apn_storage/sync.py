@@ -1,11 +1,16 @@
+import atexit
+import itertools
 import multiprocessing
 import os
 import logging
-import Queue
 
-from fs.errors import ParentDirectoryMissingError, ResourceNotFoundError
+from fs.errors import ResourceNotFoundError
 
-from apn_storage.utils import copy_file, walk_files
+from apn_storage.utils import copy_file, find_s3fs, pathcombine, walk_files
+
+
+# The number of actions sent to worker processes at a time.
+BATCH_SIZE = 64
 
 
 def sync_fs(source_fs, target_fs, delete_missing=False, processes=0, verbosity=0):
@@ -47,165 +52,266 @@ def sync_files(source_fs, source_files, target_fs, target_files, delete_missing=
 
     if processes:
 
-        errored = multiprocessing.Event()
-        finished = multiprocessing.Event()
-        file_queue = multiprocessing.JoinableQueue(maxsize=1000)
+        # The pool is kept between calls, and its workers are given the
+        # filesystems once when they start, rather than with every action.
+        # The pool splits the actions into batches for the workers. Sending
+        # actions in batches avoids the per item locking and pickling cost.
+        pool = _get_pool(processes, source_fs, target_fs, verbosity)
+        try:
+            results = list(pool.imap_unordered(_process_action, actions, chunksize=BATCH_SIZE))
+        except:
+            # Stop the rest of a failed sync, rather than leaving its
+            # workers running while the next call uses the same pool.
+            _close_pools(terminate=True)
+            raise
 
-        for x in range(processes):
-            multiprocessing.Process(
-                target=_process_files,
-                kwargs={
-                    'source_fs': source_fs,
-                    'target_fs': target_fs,
-                    'file_queue': file_queue,
-                    'finished': finished,
-                    'errored': errored,
-                    'verbosity': verbosity,
-                },
-            ).start()
+        return all(results)
 
-        for action in actions:
-            file_queue.put(action)
+    else:
 
-        file_queue.join()
-        finished.set()
+        for action, path in actions:
+            _get_action_handler(action)(source_fs, target_fs, path, verbosity)
 
-        return not errored.is_set()
+        return True
 
-    else:
 
-        for action, path in actions:
+# Worker pools kept between calls to sync_files, by their arguments.
+_pools = {}
 
-            if action is upload_file:
-                upload_file(source_fs, target_fs, path, verbosity=verbosity)
-            elif action is delete_file:
-                delete_file(target_fs, path, verbosity=verbosity)
-            elif action is skip_file:
-                skip_file(path, verbosity=verbosity)
-            else:
-                raise ValueError(action)
 
-        return True
+def _get_pool(processes, source_fs, target_fs, verbosity):
+    """
+    Returns a multiprocessing pool of workers that sync files between the
+    given filesystems. The pool is kept for the next call, so that syncing
+    the same filesystems again doesn't fork new processes or set up new
+    connections. The filesystems are compared by identity, because the
+    workers have their own copies of them. A pool kept for other arguments
+    is closed first, so that stale workers don't keep running.
 
+    """
+    key = (processes, source_fs, target_fs, verbosity)
+    pool = _pools.get(key)
+    if pool is None:
+        _close_pools()
+        pool = _pools[key] = multiprocessing.Pool(
+            processes=processes,
+            initializer=_init_worker,
+            initargs=(source_fs, target_fs, verbosity),
+        )
+    return pool
+
+
+def _close_pools(terminate=False):
+    """
+    Closes any kept worker pools and waits for their workers to exit.
+    Use terminate=True to stop the workers without finishing their tasks.
 
-def _get_sync_actions(source_files, target_files):
     """
-    Iterates through the source_files and target_files, comparing the two,
-    to decide what actions need to be taken in order to synchronize them.
-    The arguments must be sequences of WalkNode instances.
-    Returns tuples of (action_func, path)
+    while _pools:
+        key, pool = _pools.popitem()
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+
+atexit.register(_close_pools)
+
+
+# The arguments for _process_action, set in each worker process.
+_worker_args = ()
+
+
+def _init_worker(source_fs, target_fs, verbosity):
+    """Stores the sync arguments in a new worker process."""
+    global _worker_args
+    _worker_args = (source_fs, target_fs, verbosity)
 
+
+def _get_sync_actions(source_files, target_files):
     """
+    Compares the source_files and target_files to decide what actions need
+    to be taken in order to synchronize them. The arguments must be
+    iterables of WalkNode instances. Returns tuples of (action_func, path)
 
-    sfile = next(source_files, None)
-    tfile = next(target_files, None)
+    Both listings are read into sorted lists of paths with matching lists
+    of sizes, and then merged using index cursors. This avoids resuming the
+    walk generators and looking up namedtuple attributes for every
+    comparison. Sorting here also guarantees that the order matches the
+    string comparisons made during the merge.
 
-    while sfile or tfile:
+    """
 
-        if sfile is None:
+    source_paths, source_sizes = _sorted_listing(source_files)
+    target_paths, target_sizes = _sorted_listing(target_files)
+
+    # Bind the actions to locals, because they are used for every file.
+    skip = skip_file
+    upload = upload_file
+    delete = delete_file
+
+    if source_paths == target_paths:
+        # Both sides have the same files, which is the usual case when
+        # syncing again. The lists were compared in C, so only the sizes
+        # need to be checked here.
+        for path, source_size, target_size in itertools.izip(source_paths, source_sizes, target_sizes):
+            if source_size == target_size:
+                yield (skip, path)
+            else:
+                yield (upload, path)
+        return
 
-            # There are no more source files. All remaining target files are
-            # files that don't exist on the source and can be deleted.
-            yield (delete_file, tfile.path)
-            tfile = next(target_files, None)
+    source_count = len(source_paths)
+    target_count = len(target_paths)
+    source_index = 0
+    target_index = 0
 
-        elif tfile is None:
+    while source_index < source_count and target_index < target_count:
 
-            # There are no more target files. All remaining source files are
-            # files that don't exist on the target, and can be uploaded.
-            yield (upload_file, sfile.path)
-            sfile = next(source_files, None)
+        source_path = source_paths[source_index]
+        target_path = target_paths[target_index]
 
-        elif sfile.path == tfile.path:
+        if source_path == target_path:
 
             # The same file exists in both places. If the filesizes are the
             # same, then assume the contents are too. Otherwise, replace it.
-            if sfile.size == tfile.size:
-                yield (skip_file, sfile.path)
+            if source_sizes[source_index] == target_sizes[target_index]:
+                yield (skip, source_path)
             else:
-                yield (upload_file, sfile.path)
-            sfile = next(source_files, None)
-            tfile = next(target_files, None)
+                yield (upload, source_path)
+            source_index += 1
+            target_index += 1
 
-        elif sfile.path > tfile.path:
+        elif source_path > target_path:
 
             # The source path is further along than the target path.
             # This means that the target path doesn't exist on the source,
             # and it should be deleted.
-            yield (delete_file, tfile.path)
-            tfile = next(target_files, None)
+            yield (delete, target_path)
+            target_index += 1
 
-        elif tfile.path > sfile.path:
+        else:
 
             # The target path is further along than the source path.
             # This means that the source file doesn't exist on the target,
             # and it should be uploaded.
-            yield (upload_file, sfile.path)
-            sfile = next(source_files, None)
+            yield (upload, source_path)
+            source_index += 1
 
-        else:
-            raise ValueError('This should be logically impossible. %s vs %s' % (sfile, tfile))
+    # There are no more target files. All remaining source files are
+    # files that don't exist on the target, and can be uploaded.
+    for source_path in source_paths[source_index:]:
+        yield (upload, source_path)
+
+    # There are no more source files. All remaining target files are
+    # files that don't exist on the source and can be deleted.
+    for target_path in target_paths[target_index:]:
+        yield (delete, target_path)
 
 
-def _process_files(source_fs, target_fs, file_queue, finished, errored, verbosity=0):
+def _sorted_listing(nodes):
+    """
+    Reads WalkNode instances into a list of paths and a list of sizes,
+    both sorted by path. Large syncs can involve millions of files, and
+    this uses less memory than keeping a tuple for each file.
+
+    """
+
+    paths = []
+    sizes = []
+    for node in nodes:
+        paths.append(node.path)
+        sizes.append(node.size or 0)
+
+    order = sorted(xrange(len(paths)), key=paths.__getitem__)
+    paths = [paths[index] for index in order]
+    sizes = [sizes[index] for index in order]
+
+    return paths, sizes
+
+
+def _process_action(action):
     """
     A function for multiprocessing worker processes to run.
-    Reads actions from the file_queue and performs them.
+    Performs a single action and returns whether it succeeded.
 
     """
-    while True:
-        try:
-            action, path = file_queue.get(timeout=1)
-        except Queue.Empty:
-            if finished.is_set():
-                break
-        else:
-            try:
-                if action is upload_file:
-                    upload_file(source_fs, target_fs, path, verbosity=verbosity)
-                elif action is delete_file:
-                    delete_file(target_fs, path, verbosity=verbosity)
-                elif action is skip_file:
-                    skip_file(path, verbosity=verbosity)
-                else:
-                    raise ValueError(path)
-            except Exception:
-                errored.set()
-                raise
-            file_queue.task_done()
+    source_fs, target_fs, verbosity = _worker_args
+    action, path = action
+    try:
+        _get_action_handler(action)(source_fs, target_fs, path, verbosity)
+    except Exception:
+        # Record the failure and carry on with the other files.
+        logging.exception('Error syncing %r', path)
+        return False
+    return True
 
 
 def upload_file(source_fs, target_fs, path, verbosity=0):
     """Copies a file from the source_fs to the target_fs."""
-    logging.info('Uploading %r' % path, also_print=(verbosity >= 1))
-    # There are some issues with copy_file when using multiprocessing and OSFS.
-    # I'm not sure why it happens. For now, this just retries until it works.
-    for x in xrange(100):
-        try:
-            copy_file(source_fs, path, target_fs, path, chunk_size=1024 * 1024)
-        except ParentDirectoryMissingError:
+    logging.info('Uploading %r', path, also_print=(verbosity >= 1))
+    # copy_file creates the target directory and retries once if it raises
+    # ParentDirectoryMissingError. Some filesystems raise ResourceNotFoundError
+    # for a missing target directory instead, so handle that here, once.
+    # Anything else is a real error and is raised straight away.
+    try:
+        copy_file(source_fs, path, target_fs, path, chunk_size=1024 * 1024)
+    except ResourceNotFoundError:
+        if source_fs.exists(path):
             target_fs.makedir(os.path.dirname(path), recursive=True, allow_recreate=True)
-        except ResourceNotFoundError:
-            if source_fs.exists(path):
-                target_fs.makedir(os.path.dirname(path), recursive=True, allow_recreate=True)
-            elif source_fs.hassyspath(path):
-                # Handle bad symlinks.
-                syspath = source_fs.getsyspath(path)
-                if os.path.islink(syspath) and not os.path.exists(syspath):
-                    logging.warning('Bad symlink: %r' % syspath)
-                    break
+            copy_file(source_fs, path, target_fs, path, chunk_size=1024 * 1024)
+        elif source_fs.hassyspath(path):
+            # Handle bad symlinks.
+            syspath = source_fs.getsyspath(path)
+            if os.path.islink(syspath) and not os.path.exists(syspath):
+                logging.warning('Bad symlink: %r', syspath)
+            else:
+                raise
         else:
-            break
-    else:
-        raise Exception('Error uploading %r' % path)
+            raise
 
 
 def delete_file(fs, path, verbosity=0):
     """Deletes a file from the fs."""
-    logging.info('Deleting %r' % path, also_print=(verbosity >= 1))
-    fs.remove(path)
+    logging.info('Deleting %r', path, also_print=(verbosity >= 1))
+    bucket_fs, sub_dir = find_s3fs(fs)
+    if bucket_fs is None:
+        fs.remove(path)
+    else:
+        # Nothing reads the file after a sync deletes it,
+        # so don't wait for S3 to stop returning it.
+        bucket_fs.remove(pathcombine(sub_dir, path), wait=False)
 
 
 def skip_file(path, verbosity=0):
     """Logs that the path is being skipped."""
-    logging.info('OK: %r' % path, also_print=(verbosity >= 2))
+    logging.info('OK: %r', path, also_print=(verbosity >= 2))
+
+
+def _handle_upload(source_fs, target_fs, path, verbosity):
+    upload_file(source_fs, target_fs, path, verbosity=verbosity)
+
+
+def _handle_delete(source_fs, target_fs, path, verbosity):
+    delete_file(target_fs, path, verbosity=verbosity)
+
+
+def _handle_skip(source_fs, target_fs, path, verbosity):
+    skip_file(path, verbosity=verbosity)
+
+
+# Maps each action function to a handler with a common signature,
+# so that performing an action is a single dictionary lookup.
+_ACTION_HANDLERS = {
+    upload_file: _handle_upload,
+    delete_file: _handle_delete,
+    skip_file: _handle_skip,
+}
+
+
+def _get_action_handler(action):
+    try:
+        return _ACTION_HANDLERS[action]
+    except KeyError:
+        raise ValueError(action)
@@ -1,4 +1,5 @@
 import contextlib
+import datetime
 import os
 import threading
 import uuid
@@ -6,14 +7,17 @@ import uuid
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import six
 
 from fs.errors import ResourceNotFoundError
 
-from apn_storage import layeredfs, s3fs
+from apn_storage import layeredfs, s3fs, views
 from apn_storage.contrib import uid
 from apn_storage.contrib.time_elapsed import time_elapsed
 from apn_storage.django_storage import FSStorage
-from apn_storage.utils import make_fs_from_string
+from apn_storage.utils import cleanup_old_files, make_fs_from_string, walk_fs
 from apn_storage.wrapfs import cachefs
 
 
@@ -21,16 +25,18 @@ class UIDTestCase(TestCase):
 
     def assertUnique(self, generate_function, loops=1000, threads=5):
 
-        generated = set()
+        results = []
 
         def generate_loop():
-            for x in xrange(loops):
-                generated.add(generate_function())
+            results.append([generate_function() for x in xrange(loops)])
 
         generate_threads = [threading.Thread(target=generate_loop) for x in xrange(threads)]
-        [thread.start() for thread in generate_threads]
-        [thread.join() for thread in generate_threads]
+        for thread in generate_threads:
+            thread.start()
+        for thread in generate_threads:
+            thread.join()
 
+        generated = set().union(*results)
         self.assertEqual(len(generated), loops * threads)
 
     def test_uid_alphanumeric(self):
@@ -45,6 +51,18 @@ class UIDTestCase(TestCase):
         junk = uid.UIDGenerator('ab')
         self.assertUnique(junk)
 
+    def test_uid_power_of_two(self):
+        # Alphabets with a power of two length use bit shifting.
+        hexadecimal = uid.UIDGenerator('0123456789abcdef')
+        self.assertUnique(hexadecimal)
+
+    def test_uid_length(self):
+        # Generated strings are padded to a fixed length, so the
+        # FSStorage suffix regex always matches them.
+        for generator in (uid.alphanumeric, uid.alphanumeric_lowercase):
+            for x in xrange(100):
+                self.assertEqual(len(generator()), generator.length)
+
     def disabled_test_uuid(self):
         # I've seen reports/questions of uuid1's uniqueness, but it seems OK.
         # The output is longer than uid's functions so I'll stick with uid.
@@ -73,6 +91,11 @@ class DjangoStorageTests(TestCase):
 
     created_dirs = False
 
+    def make_content(self):
+        # Include the test name, so a test can't pass by reading back
+        # contents written by another test or left in a cache.
+        return 'cats on s3, %s\n' % self.id()
+
     def setUp(self):
 
         if hasattr(self.storage.fs, 'fs_sequence'):
@@ -146,6 +169,7 @@ class DjangoStorageTests(TestCase):
         available_name = self.storage.get_available_name(original_name)
         self.assertNotEqual(available_name, original_name)
         self.assertFalse(' ' in available_name)
+        self.assertTrue(isinstance(available_name, six.text_type))
 
         next_name = self.storage.get_available_name(available_name)
         self.assertNotEqual(next_name, available_name)
@@ -175,7 +199,7 @@ class DjangoStorageTests(TestCase):
 
     def test_open(self):
 
-        written_content = 'cats on s3, %s\n' % uid.alphanumeric()
+        written_content = self.make_content()
 
         with timed('open/write'):
             cat = self.storage.open(self.cats, 'w')
@@ -212,7 +236,7 @@ class DjangoStorageTests(TestCase):
             self.assertFalse(self.storage.exists(self.cats))
             self.assertFalse(self.storage.exists(self.cats1))
 
-        content = 'cats on s3, %s\n' % uid.alphanumeric()
+        content = self.make_content()
 
         # Use the save method and ensure it worked.
         with timed('save'):
@@ -249,7 +273,7 @@ class DjangoStorageTests(TestCase):
 
     def test_size(self):
 
-        content = 'cats on s3, %s\n' % uid.alphanumeric()
+        content = self.make_content()
 
         with timed('setcontents'):
             self.storage.fs.setcontents(self.cats, content)
@@ -378,6 +402,228 @@ class UnicodeTests(TestCase):
         self.storage.exists(badpath_unicode)
 
 
+class WalkTests(TestCase):
+
+    def assertWalkFindsDirectories(self, fs):
+
+        fs.makedir('walk/subdir', recursive=True, allow_recreate=True)
+        fs.setcontents('walk/file.txt', 'walk')
+        fs.setcontents('walk/subdir/file.txt', 'walk')
+
+        nodes = dict((node.path, node.isdir) for node in walk_fs(fs, 'walk'))
+        self.assertEqual(nodes, {
+            'walk/file.txt': False,
+            'walk/subdir': True,
+            'walk/subdir/file.txt': False,
+        })
+
+    def test_walk_osfs(self):
+        self.assertWalkFindsDirectories(make_fs_from_string('tempfs'))
+
+    def test_walk_s3fs(self):
+        fs = make_fs_from_string('s3:apn-localdev-test1')
+        fs = fs.makeopendir('test/%s' % uid.alphanumeric(), recursive=True)
+        self.assertWalkFindsDirectories(fs)
+
+
+class S3FSTests(TestCase):
+
+    def assertContentType(self, size):
+
+        fs = make_fs_from_string('s3:apn-localdev-test1')
+        path = 'test/%s/style.css' % uid.alphanumeric()
+        fs.makedir(os.path.dirname(path), recursive=True, allow_recreate=True)
+
+        try:
+            fs.setcontents(path, ContentFile('a' * size, name='style.css'))
+            key = fs._s3bukt.get_key(fs._s3path(path))
+            self.assertEqual(key.content_type, 'text/css')
+        finally:
+            fs.remove(path)
+
+    def test_content_type(self):
+        self.assertContentType(100)
+
+    def test_multipart_content_type(self):
+        self.assertContentType(s3fs.S3FS.multipart_size + 100)
+
+    def test_multipart_parts(self):
+
+        class FakeUpload(object):
+            id = 'upload'
+            completed = False
+
+            def complete_upload(self):
+                self.completed = True
+
+        class FakeBucket(object):
+            def initiate_multipart_upload(self, key_name, headers=None):
+                self.upload = FakeUpload()
+                return self.upload
+
+        class PartRecordingS3FS(s3fs.S3FS):
+            # Record the parts rather than uploading them to S3.
+            _s3bukt = FakeBucket()
+            _key_sync_timeout = None
+            multipart_size = 8
+
+            def __init__(self):
+                self._prefix = ''
+                self._separator = '/'
+                self._tlocal = threading.local()
+                self.parts = []
+
+            def _upload_part(self, upload_id, s3path, part_num, part):
+                self.parts.append((part_num, part))
+
+        class ShortReadFile(six.BytesIO):
+            def read(self, size=-1):
+                return six.BytesIO.read(self, min(size, 3))
+
+        source_file = ShortReadFile('cats in the cache')
+        source_file.read()
+
+        fs = PartRecordingS3FS()
+        fs.setcontents('cats.txt', source_file)
+        self.assertEqual(sorted(fs.parts), [(1, 'cats in '), (2, 'the cach'), (3, 'e')])
+        self.assertTrue(fs._s3bukt.upload.completed)
+
+
+class CleanupTests(TestCase):
+
+    def assertCleanupRemovesOldFiles(self, fs):
+
+        fs.makedir('cleanup/subdir', recursive=True, allow_recreate=True)
+        fs.setcontents('cleanup/file.txt', 'cleanup')
+        fs.setcontents('cleanup/subdir/file.txt', 'cleanup')
+
+        removed = cleanup_old_files(fs, datetime.timedelta(days=1), 'cleanup')
+        self.assertEqual(removed, [])
+
+        removed = cleanup_old_files(fs, datetime.timedelta(0), 'cleanup', 'missing')
+        self.assertEqual(sorted(removed), ['cleanup/file.txt', 'cleanup/subdir/file.txt'])
+        self.assertFalse(fs.exists('cleanup/file.txt'))
+        self.assertFalse(fs.exists('cleanup/subdir/file.txt'))
+
+    def test_cleanup_osfs(self):
+        self.assertCleanupRemovesOldFiles(make_fs_from_string('tempfs'))
+
+    def test_cleanup_s3fs(self):
+        fs = make_fs_from_string('s3:apn-localdev-test1')
+        fs = fs.makeopendir('test/%s' % uid.alphanumeric(), recursive=True)
+        self.assertCleanupRemovesOldFiles(fs)
+
+
+class CacheFSTests(TestCase):
+
+    def test_read_through(self):
+
+        fs = make_fs_from_string('tempfs')
+        cache_fs = cachefs.enable_caching(fs, cachefs=make_fs_from_string('tempfs'))
+        cache_fs.copy_chunk_size = 4
+
+        fs.makedir('subdir')
+        fs.setcontents('subdir/cats.txt', 'cats in the cache')
+
+        for mode in ('rb', 'r'):
+            cached_file = cache_fs.open('subdir/cats.txt', mode)
+            try:
+                self.assertEqual(cached_file.read(), 'cats in the cache')
+            finally:
+                cached_file.close()
+            self.assertEqual(cache_fs.cachefs.getcontents('subdir/cats.txt'), 'cats in the cache')
+            cache_fs.cachefs.remove('subdir/cats.txt')
+
+    def test_short_reads(self):
+
+        class ShortReadFile(six.BytesIO):
+            def read(self, size=-1):
+                return six.BytesIO.read(self, min(size, 3))
+
+        for contents in ('cats', 'cats in the cache'):
+            target_file = six.BytesIO()
+            cachefs.copy_with_read_ahead(ShortReadFile(contents), target_file, chunk_size=4, chunks=2)
+            self.assertEqual(target_file.getvalue(), contents)
+
+    def test_test_mode(self):
+
+        fs = make_fs_from_string('tempfs')
+        cache_fs = cachefs.enable_caching(fs, cachefs=make_fs_from_string('tempfs'))
+        fs.setcontents('cats.txt', 'cats in the cache')
+
+        cache_fs.enable_test_mode()
+        test_cache = cache_fs.cachefs
+        cache_fs.getcontents('cats.txt')
+        self.assertTrue(test_cache.exists('cats.txt'))
+        cache_fs.disable_test_mode()
+
+        # The temporary cache is reused, but it starts empty each time.
+        cache_fs.enable_test_mode()
+        self.assertTrue(cache_fs.cachefs is test_cache)
+        self.assertFalse(test_cache.exists('cats.txt'))
+        cache_fs.disable_test_mode()
+
+
+class ServeTests(TestCase):
+
+    def assertServeRedirect(self, path, expected_path):
+        request = RequestFactory().get('/media/%s' % path)
+        response = views.serve(request, path, storage=None)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], expected_path)
+
+    def test_parent_directory_redirect(self):
+        self.assertServeRedirect('../cats.txt', 'cats.txt')
+        self.assertServeRedirect('subdir/../../cats.txt', 'cats.txt')
+
+    def test_backslash_redirect(self):
+        self.assertServeRedirect('subdir\\dogs.txt', 'subdir/dogs.txt')
+
+    def test_not_modified(self):
+
+        storage = FSStorage(make_fs_from_string('tempfs'), base_url=settings.MEDIA_STORAGE_URL)
+        storage.fs.setcontents('cats.txt', 'cats')
+
+        request = RequestFactory().get('/media/cats.txt')
+        response = views.serve(request, 'cats.txt', storage=storage)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'])
+
+        request = RequestFactory().get('/media/cats.txt', HTTP_IF_NONE_MATCH=response['ETag'])
+        response = views.serve(request, 'cats.txt', storage=storage)
+        self.assertEqual(response.status_code, 304)
+
+        request = RequestFactory().get('/media/cats.txt', HTTP_IF_NONE_MATCH='"other"')
+        response = views.serve(request, 'cats.txt', storage=storage)
+        self.assertEqual(response.status_code, 200)
+
+    def test_cache_control(self):
+
+        storage = FSStorage(make_fs_from_string('tempfs'), base_url=settings.MEDIA_STORAGE_URL)
+        storage.fs.setcontents('cats.txt', 'cats')
+        request = RequestFactory().get('/media/cats.txt')
+
+        response = views.serve(request, 'cats.txt', storage=storage)
+        self.assertEqual(response['Cache-Control'], 'private, max-age=%d' % views.CACHE_MAX_AGE)
+
+        with override_settings(MEDIA_STORAGE_CACHE_MAX_AGE=60, MEDIA_STORAGE_PUBLIC_CACHE=True):
+            response = views.serve(request, 'cats.txt', storage=storage)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+    def test_headers_without_streaming(self):
+
+        storage = FSStorage(make_fs_from_string('tempfs'), base_url=settings.MEDIA_STORAGE_URL)
+        storage.fs.setcontents('cats.txt', 'cats')
+        os.utime(storage.fs.getsyspath('cats.txt'), (1000000000, 1000000000))
+        request = RequestFactory().get('/media/cats.txt')
+
+        streamed_response = views.serve(request, 'cats.txt', storage=storage)
+        response = views.serve(request, 'cats.txt', storage=storage, stream=False)
+        self.assertEqual(response.content, 'cats')
+        self.assertEqual(response['ETag'], streamed_response['ETag'])
+        self.assertEqual(response['Last-Modified'], streamed_response['Last-Modified'])
+
+
 @contextlib.contextmanager
 def timed(*args):
     disabled = True
@@ -1,14 +1,23 @@
 import codecs
 import collections
 import datetime
+import errno
 import functools
+import itertools
+import operator
 import os
+import shutil
+import stat
 import threading
 
-from fs import osfs, tempfs, utils
-from fs.errors import ParentDirectoryMissingError, ResourceNotFoundError
+from multiprocessing.pool import ThreadPool
 
-from apn_storage import httpfs, s3fs
+from fs import multifs, osfs, tempfs, utils
+from fs import path as fs_path
+from fs.errors import DestinationExistsError, ParentDirectoryMissingError, ResourceNotFoundError
+from fs.wrapfs import WrapFS
+
+from apn_storage import s3fs
 
 
 def thread_locked(func):
@@ -28,13 +37,18 @@ def thread_locked(func):
     return locked_func
 
 
-@thread_locked
+_make_fs_lock = threading.Lock()
+
+
 def make_fs_from_string(string, _cache={}):
     """
     Create a FS object from a string. Uses a cache to avoid creating multiple
     FS objects for any given string (except for tempfs which allows multple
     instances).
 
+    Cached objects are returned without locking. The lock is only used
+    when creating a new object, so that only one thread creates it.
+
     """
 
     if string == 'tempfs':
@@ -46,9 +60,21 @@ def make_fs_from_string(string, _cache={}):
     if string.startswith('~/'):
         string = os.path.expanduser(string)
 
-    if string in _cache:
+    try:
+        return _cache[string]
+    except KeyError:
+        pass
+
+    with _make_fs_lock:
+        # Another thread may have created it while waiting for the lock.
+        if string not in _cache:
+            _cache[string] = _make_fs(string)
         return _cache[string]
 
+
+def _make_fs(string):
+    """Create a FS object from a string. See make_fs_from_string."""
+
     if string.startswith('/'):
 
         # Use a simple directory on the filesystem.
@@ -90,15 +116,44 @@ def make_fs_from_string(string, _cache={}):
 
     elif string.startswith('http://'):
 
+        # Imported here because httpfs uses memoize from this module.
+        from apn_storage import httpfs
+
         fs = httpfs.HTTPFS(string)
 
     else:
         raise ValueError('Unsupported storage string %r' % string)
 
-    _cache[string] = fs
     return fs
 
 
+def memoize(max_size):
+    """
+    Decorate a function of one argument so that its results are cached.
+    The cache is cleared when it reaches max_size, which keeps its memory
+    use bounded without the bookkeeping of a least recently used cache.
+
+    """
+
+    def decorator(func):
+
+        cache = {}
+
+        @functools.wraps(func)
+        def memoized_func(arg):
+            try:
+                return cache[arg]
+            except KeyError:
+                if len(cache) >= max_size:
+                    cache.clear()
+                result = cache[arg] = func(arg)
+                return result
+
+        return memoized_func
+
+    return decorator
+
+
 def pathcombine(path1, path2):
     """
     Note: This is copied from:
@@ -118,33 +173,106 @@ def pathcombine(path1, path2):
     return '%s/%s' % (path1.rstrip('/'), path2.lstrip('/'))
 
 
+def normpath(path):
+    """
+    A faster version of fs.path.normpath for paths that are already
+    normalized, which most paths are. This avoids the function's regex
+    search, and only calls it for paths that might need normalizing.
+
+    >>> normpath("foo/bar")
+    'foo/bar'
+
+    >>> normpath("foo/./bar/")
+    u'foo/bar'
+
+    """
+    if '/.' in path or '//' in path or path.endswith('/') or path.startswith('.'):
+        return fs_path.normpath(path)
+    return path
+
+
+# The number of threads used to check and delete old files.
+CLEANUP_THREADS = 32
+
+
 def find_old_files(fs, timedelta):
-    """Find all files with a modified time older than the timedelta."""
-    for path in fs.walkfiles():
-        info = fs.getinfo(path)
-        modified = info['modified_time']
-        age = datetime.datetime.now() - modified
-        if age > timedelta:
-            yield path
+    """
+    Find all files with a modified time older than the timedelta.
+    The files are checked by a pool of threads, because each check
+    is a separate request for some filesystems.
+
+    """
+    paths = list(fs.walkfiles())
+    if not paths:
+        return
+    pool = ThreadPool(min(CLEANUP_THREADS, len(paths)))
+    try:
+        for path, info in itertools.izip(paths, pool.imap(fs.getinfo, paths, chunksize=16)):
+            modified = info['modified_time']
+            age = datetime.datetime.now() - modified
+            if age > timedelta:
+                yield path
+    finally:
+        pool.terminate()
+
+
+def find_s3fs(fs):
+    """
+    Find the S3FS behind a filesystem and the directory it represents,
+    looking through any SubFS returned by opendir(). Returns (None, None)
+    for filesystems that are not stored in S3.
+
+    """
+    sub_dir = ''
+    while not isinstance(fs, s3fs.S3FS):
+        parent_dir = getattr(fs, 'sub_dir', None)
+        if parent_dir is None:
+            return None, None
+        sub_dir = pathcombine(parent_dir, sub_dir)
+        fs = fs.wrapped_fs
+    return fs, sub_dir
+
+
+def _remove_file(fs, path):
+    """Remove a file, returning whether it existed."""
+    try:
+        fs.remove(path)
+    except ResourceNotFoundError:
+        return False
+    return True
 
 
 def cleanup_old_files(fs, timedelta, *paths):
-    """Delete files with a modified time older than the timedelta."""
+    """
+    Delete files with a modified time older than the timedelta.
+
+    Files in S3 are deleted in batches. Files in other
+    filesystems are deleted by a pool of threads.
+
+    """
     removed = []
     for root_path in paths:
         try:
             path_fs = fs.opendir(root_path)
+            bucket_fs, sub_dir = find_s3fs(path_fs)
         except ResourceNotFoundError:
             pass
         else:
-            for path in find_old_files(path_fs, timedelta):
+            old_paths = list(find_old_files(path_fs, timedelta))
+            if not old_paths:
+                continue
+            if bucket_fs is not None:
+                deleted = set(bucket_fs.removemany([pathcombine(sub_dir, path) for path in old_paths]))
+                existed = [pathcombine(sub_dir, path) in deleted for path in old_paths]
+            else:
+                pool = ThreadPool(min(CLEANUP_THREADS, len(old_paths)))
                 try:
-                    path_fs.remove(path)
-                except ResourceNotFoundError:
-                    pass
-                else:
-                    full_path = pathcombine(root_path, path)
-                    removed.append(full_path)
+                    existed = pool.map(functools.partial(_remove_file, path_fs), old_paths)
+                finally:
+                    pool.terminate()
+            for path, was_removed in zip(old_paths, existed):
+                if was_removed:
+                    removed.append(pathcombine(root_path, path))
     return removed
 
 
@@ -156,16 +284,66 @@ def copy_file(source_fs, source_path, target_fs, target_path, overwrite=True, cr
 
     """
 
+    source_syspath = source_fs.getsyspath(source_path, allow_none=True)
+    target_syspath = target_fs.getsyspath(target_path, allow_none=True)
+
+    if source_syspath is not None and target_syspath is not None and source_fs is not target_fs:
+        # Both files are on the local disk, so copy them directly.
+        copy = functools.partial(
+            _copy_local_file,
+            source_syspath, source_path,
+            target_syspath, target_path,
+            overwrite=overwrite,
+            chunk_size=chunk_size,
+        )
+    else:
+        copy = functools.partial(
+            utils.copyfile,
+            source_fs, source_path,
+            target_fs, target_path,
+            overwrite=overwrite,
+            chunk_size=chunk_size,
+        )
+
     try:
-        utils.copyfile(source_fs, source_path, target_fs, target_path, overwrite=overwrite, chunk_size=chunk_size)
+        copy()
     except ParentDirectoryMissingError:
         if create_directory:
             target_fs.makedir(os.path.dirname(target_path), recursive=True, allow_recreate=True)
-            utils.copyfile(source_fs, source_path, target_fs, target_path, overwrite=overwrite, chunk_size=chunk_size)
+            copy()
         else:
             raise
 
 
+def _copy_local_file(source_syspath, source_path, target_syspath, target_path, overwrite, chunk_size):
+    """
+    Copy a file between system paths using the given chunk size. The
+    fs library uses shutil.copyfile for this, which only reads 16 KiB at
+    a time. Errors are converted into the fs library's exceptions.
+
+    """
+
+    if not overwrite and os.path.exists(target_syspath):
+        raise DestinationExistsError(target_path)
+
+    try:
+        source_file = open(source_syspath, 'rb')
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            raise ResourceNotFoundError(source_path)
+        raise
+
+    with source_file:
+        try:
+            target_file = open(target_syspath, 'wb')
+        except IOError as error:
+            if error.errno == errno.ENOENT:
+                raise ParentDirectoryMissingError(target_path)
+            raise
+        with target_file:
+            shutil.copyfileobj(source_file, target_file, chunk_size)
+
+
 def move_file(fs, current_path, target_path, overwrite=True):
 
     try:
@@ -193,37 +371,102 @@ def use_codec(open_file, encoding=None, errors='strict'):
 
 WalkNode = collections.namedtuple('WalkNode', ('path', 'isdir', 'size'))
 
+# The number of threads used by walk_fs to list directories concurrently.
+WALK_THREADS = 32
+
+
+def _list_directory(fs, path, sort):
+    """
+    Returns a list of WalkNode instances for the contents of a directory.
+    Uses st_mode from the info dicts to avoid isdir checks where possible.
 
-def walk_fs(fs, path='/', sort=True, max_depth=float('inf')):
+    """
 
     nodes = []
 
     for (path, info) in fs.ilistdirinfo(path, full=True):
+        if 'st_mode' in info:
+            isdir = stat.S_ISDIR(info['st_mode'])
+        else:
+            isdir = fs.isdir(path)
         node = WalkNode(
             path=path,
-            isdir=fs.isdir(path),
+            isdir=isdir,
             size=info.get('size', 0),
         )
         nodes.append(node)
 
     if sort:
-        nodes.sort()
-
-    for node in nodes:
-        yield node
-        if node.isdir:
-            if max_depth > 0:
-                children = walk_fs(
-                    fs=fs,
-                    path=node.path,
-                    sort=sort,
-                    max_depth=max_depth - 1,
-                )
-                for child_node in children:
-                    yield child_node
-
-
-def walk_files(fs, path='/', sort=True, max_depth=float('inf')):
-    for node in walk_fs(fs, path=path, sort=sort, max_depth=max_depth):
+        # Paths within a directory are unique, so sorting by the path alone
+        # gives the same order as comparing whole nodes, but faster.
+        nodes.sort(key=operator.itemgetter(0))
+
+    return nodes
+
+
+def _is_local_fs(fs):
+    """
+    Check whether a filesystem is stored on local disk, looking through
+    any wrappers and checking every layer of a MultiFS.
+
+    """
+    if isinstance(fs, multifs.MultiFS):
+        return all(_is_local_fs(layer) for layer in fs)
+    if isinstance(fs, WrapFS):
+        return _is_local_fs(fs.wrapped_fs)
+    return fs.getsyspath('/', allow_none=True) is not None
+
+
+def walk_fs(fs, path='/', sort=True, max_depth=float('inf'), threads=WALK_THREADS):
+    """
+    Generates WalkNode instances for everything under the path, depth first.
+
+    Listing a directory on a remote filesystem takes a network round trip,
+    so subdirectories are listed by a pool of threads as soon as they are
+    found, rather than one at a time when the walk reaches them. This does
+    not change the order of the results. Set threads=0 to disable this.
+    Local filesystems are always listed without threads, because their
+    listings are quick system calls that the threads would only slow down.
+
+    """
+
+    pool = ThreadPool(threads) if threads and not _is_local_fs(fs) else None
+
+    def list_directory(path):
+        if pool:
+            return pool.apply_async(_list_directory, (fs, path, sort)).get
+        else:
+            return functools.partial(_list_directory, fs, path, sort)
+
+    def get_entries(get_nodes, depth):
+        # Start listing the subdirectories before returning the nodes,
+        # so those listings are in progress while the nodes are consumed.
+        nodes = get_nodes()
+        entries = []
+        for node in nodes:
+            if node.isdir and depth > 0:
+                entries.append((node, list_directory(node.path)))
+            else:
+                entries.append((node, None))
+        return iter(entries), depth
+
+    try:
+        stack = [get_entries(list_directory(path), max_depth)]
+        while stack:
+            entries, depth = stack[-1]
+            for node, get_child_nodes in entries:
+                yield node
+                if get_child_nodes:
+                    stack.append(get_entries(get_child_nodes, depth - 1))
+                    break
+            else:
+                stack.pop()
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def walk_files(fs, path='/', sort=True, max_depth=float('inf'), threads=WALK_THREADS):
+    for node in walk_fs(fs, path=path, sort=sort, max_depth=max_depth, threads=threads):
         if not node.isdir:
             yield node
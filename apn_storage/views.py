@@ -2,16 +2,34 @@ import datetime
 import mimetypes
 import os
 import posixpath
+import re
 import time
 import urllib
 
+from django.conf import settings
 from django.core.servers.basehttp import FileWrapper
 from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseNotModified
-from django.utils.http import http_date
+from django.utils.http import http_date, parse_etags
 from django.views.static import was_modified_since
 
 from fs.errors import ResourceNotFoundError
 
+from apn_storage.utils import memoize
+
+
+# Matches normalized paths that still need cleaning up by serve: paths
+# containing '.' or '..' components, or backslashes.
+_unsafe_path_re = re.compile(r'(?:^|/)\.\.?(?:/|$)|\\')
+
+# The number of bytes to read at a time when streaming files. Reads from
+# remote filesystems can involve a network request, so this is larger
+# than the default of 8 KiB.
+STREAM_BLOCK_SIZE = 256 * 1024
+
+# How long browsers and proxies may cache stored files for, in seconds,
+# unless the MEDIA_STORAGE_CACHE_MAX_AGE setting is used.
+CACHE_MAX_AGE = 60 * 60
+
 
 def serve(request, path, document_root='', storage=None, stream=True):
     """
@@ -29,26 +47,32 @@ def serve(request, path, document_root='', storage=None, stream=True):
     # Clean up given path to only allow serving files below document_root.
     path = posixpath.normpath(urllib.unquote(path))
     path = path.lstrip('/')
-    newpath = ''
-    for part in path.split('/'):
-        if not part:
-            # Strip empty path components.
-            continue
-        drive, part = os.path.splitdrive(part)
-        head, part = os.path.split(part)
-        if part in (os.curdir, os.pardir):
-            # Strip '.' and '..' in path.
-            continue
-        newpath = os.path.join(newpath, part).replace('\\', '/')
+    if _unsafe_path_re.search(path) is None:
+        # After normalizing, most paths don't need any more cleaning up.
+        newpath = path
+    else:
+        newpath = ''
+        for part in path.split('/'):
+            if not part:
+                # Strip empty path components.
+                continue
+            drive, part = os.path.splitdrive(part)
+            head, part = os.path.split(part)
+            if part in (os.curdir, os.pardir):
+                # Strip '.' and '..' in path.
+                continue
+            newpath = os.path.join(newpath, part).replace('\\', '/')
     if newpath and path != newpath:
         return HttpResponseRedirect(newpath)
 
     fullpath = os.path.join(document_root, newpath)
 
-    mimetype, encoding = mimetypes.guess_type(fullpath)
+    mimetype, encoding = guess_type(fullpath)
     mimetype = mimetype or 'application/octet-stream'
 
-    # Respect the If-Modified-Since header.
+    # Respect the If-None-Match and If-Modified-Since headers. This is
+    # checked before opening the file, so that the file is never read
+    # when the client already has it.
     try:
         file_info = storage.fs.getinfo(fullpath)
     except (OSError, ResourceNotFoundError):
@@ -58,8 +82,16 @@ def serve(request, path, document_root='', storage=None, stream=True):
         modified_time = file_info['modified_time']
         if isinstance(modified_time, datetime.datetime):
             modified_time = int(time.mktime(modified_time.timetuple()))
-        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), modified_time, size):
-            return HttpResponseNotModified(mimetype=mimetype)
+        etag = '%d-%d' % (size, modified_time)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            not_modified = if_none_match == '*' or etag in parse_etags(if_none_match)
+        else:
+            not_modified = not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), modified_time, size)
+        if not_modified:
+            response = HttpResponseNotModified(mimetype=mimetype)
+            _set_cache_headers(response, etag)
+            return response
 
     # Try to open the file without checking if it exists first. This allows
     # custom FS wrappers to activate for missing thumbnail images.
@@ -74,10 +106,15 @@ def serve(request, path, document_root='', storage=None, stream=True):
         contents = open_file.read()
         open_file.close()
         size = len(contents)
-        modified_time = int(time.time())
+        if file_info is None:
+            modified_time = int(time.time())
+        else:
+            # Keep the modified time from the same info as the Etag,
+            # and make the Etag match the contents being returned.
+            etag = '%d-%d' % (size, modified_time)
     else:
         # Stream the file contents without reading it into memory.
-        contents = FileWrapper(open_file)
+        contents = FileWrapper(open_file, blksize=STREAM_BLOCK_SIZE)
 
     response = HttpResponse(contents, mimetype=mimetype)
     response['Last-Modified'] = http_date(modified_time)
@@ -85,9 +122,47 @@ def serve(request, path, document_root='', storage=None, stream=True):
     if encoding:
         response['Content-Encoding'] = encoding
 
-    # Set a blank Etag to prevent the file contents from being read by
-    # middleware just to generate it. This should be fine, because the
-    # last-modified date is a good enough way to tell if a file has changed.
-    response['ETag'] = ''
+    if file_info is None:
+        # Set a blank Etag to prevent the file contents from being read by
+        # middleware just to generate it. This should be fine, because the
+        # last-modified date is a good enough way to tell if a file has changed.
+        response['ETag'] = ''
+    else:
+        _set_cache_headers(response, etag)
 
     return response
+
+
+def _set_cache_headers(response, etag):
+    """
+    Set headers allowing browsers and proxies to cache a stored file.
+    The Etag is made from the file's size and modified time, so it
+    can be checked without reading the file.
+
+    Only browsers may cache the files by default, because they could be
+    private. Set MEDIA_STORAGE_PUBLIC_CACHE = True to allow proxies and
+    other shared caches to store them as well.
+
+    """
+    response['ETag'] = '"%s"' % etag
+    max_age = getattr(settings, 'MEDIA_STORAGE_CACHE_MAX_AGE', CACHE_MAX_AGE)
+    if getattr(settings, 'MEDIA_STORAGE_PUBLIC_CACHE', False):
+        response['Cache-Control'] = 'public, max-age=%d' % max_age
+    else:
+        response['Cache-Control'] = 'private, max-age=%d' % max_age
+
+
+def guess_type(path):
+    """
+    A cached version of mimetypes.guess_type. The result only depends on
+    the last two extensions of the filename (e.g. ".tar.gz"), so those are
+    used as the cache key.
+
+    """
+    root, extension = posixpath.splitext(path)
+    return _guess_type_for_extensions(posixpath.splitext(root)[1] + extension)
+
+
+@memoize(max_size=1024)
+def _guess_type_for_extensions(extensions):
+    return mimetypes.guess_type('file' + extensions)
@@ -1,16 +1,35 @@
-import functools
 import os
+import shutil
+
+from multiprocessing.pool import ThreadPool
 
 from fs import filelike, tempfs, wrapfs
 from fs.errors import ResourceNotFoundError
-from fs.path import normpath
+
+from apn_storage.utils import normpath
+
+
+# Python 2 reads the same bytes in 'r' and 'rb' modes on POSIX systems,
+# so a file opened in binary mode can be returned for either mode.
+if os.name == 'posix':
+    BINARY_READ_MODES = ('rb', 'r')
+else:
+    BINARY_READ_MODES = ('rb',)
 
 
 class CacheFS(wrapfs.WrapFS):
 
+    # The number of bytes to copy at a time when caching a file.
+    copy_chunk_size = 1024 * 1024
+
+    # The number of chunks to read ahead while caching a file.
+    # Set this to 0 to copy files without a read-ahead thread.
+    prefetch_chunks = 4
+
     def __init__(self, fs, cachefs):
         self.cachefs = cachefs
         self.test_mode = False
+        self._test_cachefs = None
         super(CacheFS, self).__init__(fs)
 
     def __del__(self):
@@ -27,10 +46,26 @@ class CacheFS(wrapfs.WrapFS):
         except ResourceNotFoundError:
             pass
 
+    def close(self):
+        if self._test_cachefs is not None:
+            self._test_cachefs.close()
+            self._test_cachefs = None
+        super(CacheFS, self).close()
+
     def enable_test_mode(self):
         if not self.test_mode:
+            # Reuse the same temporary directory each time, and empty
+            # it so that each test starts with nothing in the cache.
+            if self._test_cachefs is None:
+                self._test_cachefs = tempfs.TempFS()
+            else:
+                for path in self._test_cachefs.listdir('/', full=True):
+                    if self._test_cachefs.isdir(path):
+                        self._test_cachefs.removedir(path, force=True)
+                    else:
+                        self._test_cachefs.remove(path)
             self._cachefs = self.cachefs
-            self.cachefs = tempfs.TempFS()
+            self.cachefs = self._test_cachefs
             self.test_mode = True
 
     def disable_test_mode(self):
@@ -40,6 +75,8 @@ class CacheFS(wrapfs.WrapFS):
 
     def open(self, path, mode='r', *args, **kwargs):
 
+        # Normalize the path once here, and reuse it for both filesystems
+        # and for purging the cache when a written file is closed.
         path = normpath(path)
 
         if 'w' in mode or 'a' in mode or '+' in mode:
@@ -48,11 +85,10 @@ class CacheFS(wrapfs.WrapFS):
             # when it is closed, ensuring that future read operations will
             # access the underlying filesystem and get the latest version.
             open_file = super(CacheFS, self).open(path, mode=mode, *args, **kwargs)
-            purge_path = functools.partial(self._purge, path=path)
             return CacheFile(
                 open_file=open_file,
                 mode=mode,
-                on_close=purge_path,
+                on_close=lambda: self._purge(path),
             )
 
         try:
@@ -73,13 +109,17 @@ class CacheFS(wrapfs.WrapFS):
                     allow_recreate=True,
                 )
                 new_file = self.cachefs.open(path, 'wb')
+            # Copy it in chunks, so large files aren't read into memory.
             old_file.seek(0)
-            new_file.write(old_file.read())
+            if self.prefetch_chunks:
+                copy_with_read_ahead(old_file, new_file, self.copy_chunk_size, self.prefetch_chunks)
+            else:
+                shutil.copyfileobj(old_file, new_file, self.copy_chunk_size)
             new_file.close()
 
             # Now return a file. Try to reuse the existing file object if
             # it was opened with the desired mode. Otherwise, reopen it.
-            if mode == 'rb':
+            if mode in BINARY_READ_MODES:
                 old_file.seek(0)
                 return old_file
             else:
@@ -108,4 +148,40 @@ class CacheFile(filelike.FileWrapper):
             self.on_close()
 
 
+def copy_with_read_ahead(source_file, target_file, chunk_size, chunks):
+    """
+    Copy a file in chunks, while a thread reads up to the given number of
+    chunks ahead from the source file. Reading from a remote filesystem
+    involves network requests, and this lets those happen while the
+    previous chunks are being written. Files that fit in a single chunk
+    are copied without starting a thread.
+
+    Like shutil.copyfileobj, this only stops when a read returns nothing,
+    because a read can return less than a full chunk before the end.
+
+    """
+
+    data = source_file.read(chunk_size)
+    if not data:
+        return
+    target_file.write(data)
+    data = source_file.read(chunk_size)
+    if not data:
+        return
+
+    # A single thread reads the chunks, so they are read in order.
+    pool = ThreadPool(1)
+    try:
+        pending = [pool.apply_async(source_file.read, (chunk_size,)) for x in xrange(chunks)]
+        while data:
+            target_file.write(data)
+            data = pending.pop(0).get()
+            pending.append(pool.apply_async(source_file.read, (chunk_size,)))
+    finally:
+        # Wait for the remaining reads, so that nothing else
+        # uses the source file while this thread is reading it.
+        pool.close()
+        pool.join()
+
+
 enable_caching = CacheFS
@@ -6,13 +6,17 @@ https://code.google.com/p/pyfilesystem/source/browse/trunk/fs/wrapfs/hidefs.py
 """
 
 import fnmatch
+import itertools
 import re
+import stat
+
+from django.utils.functional import cached_property
 
 from fs.errors import ResourceNotFoundError
-from fs.path import iteratepath, normpath, pathjoin
+from fs.path import pathjoin
 from fs.wrapfs import rewrite_errors, WrapFS
 
-from apn_storage.utils import pathcombine
+from apn_storage.utils import memoize, normpath, pathcombine
 
 
 class HideFS(WrapFS):
@@ -26,10 +30,30 @@ class HideFS(WrapFS):
 
     """
 
+    # Flags for compiling the wildcards, e.g. re.IGNORECASE. Python 2 only
+    # uses Unicode character classes with re.UNICODE, so the default of no
+    # flags already gives the simpler ASCII matching.
+    hide_regex_flags = 0
+
+    # The number of paths to remember the _should_hide results for. Like
+    # utils.memoize, the results are forgotten when this many are cached.
+    hide_cache_size = 4096
+
     def __init__(self, wrapped_fs, *hide_wildcards):
-        self._hide_wildcards = [re.compile(fnmatch.translate(wildcard)) for wildcard in hide_wildcards]
+        self._hide_wildcards = hide_wildcards
+        self._hide_cache = {}
         super(HideFS, self).__init__(wrapped_fs)
 
+    @cached_property
+    def _hide_re(self):
+        # Combine the wildcards into one regex, so that checking a path
+        # only needs one match per part. This is compiled when first used,
+        # because some instances never check any paths.
+        if not self._hide_wildcards:
+            return None
+        pattern = '|'.join('(?:%s)' % fnmatch.translate(wildcard) for wildcard in self._hide_wildcards)
+        return re.compile(pattern, self.hide_regex_flags)
+
     def __del__(self):
         # Note: the new version of the fs library does this to avoid errors.
         if not getattr(self, 'closed', True) and hasattr(self, 'close'):
@@ -39,7 +63,35 @@ class HideFS(WrapFS):
                 pass
 
     def _should_hide(self, path):
-        return any(any(wildcard.match(part) for wildcard in self._hide_wildcards) for part in iteratepath(path))
+        if self._hide_re is None:
+            # Nothing is hidden without any wildcards.
+            return False
+        # The result only depends on the path, so it can be cached. Walking
+        # a directory checks paths with the same parent directories many
+        # times, and checking each part of a path is relatively slow. This
+        # doesn't use utils.memoize, because the cache belongs to this
+        # instance and a memoized bound method would make a reference
+        # cycle, which Python 2 can't collect because of __del__.
+        cache = self._hide_cache
+        try:
+            return cache[path]
+        except KeyError:
+            if len(cache) >= self.hide_cache_size:
+                cache.clear()
+            hidden = cache[path] = self._should_hide_uncached(path)
+            return hidden
+
+    def _should_hide_uncached(self, path):
+        # This is the same as checking each part from iteratepath,
+        # but without its extra normalizing and generator overhead.
+        path = normpath(path).lstrip('/')
+        if not path:
+            return False
+        match = self._hide_re.match
+        for part in path.split('/'):
+            if match(part):
+                return True
+        return False
 
     def _should_show(self, path):
         return not self._should_hide(path)
@@ -59,41 +111,45 @@ class HideFS(WrapFS):
             return False
         return super(HideFS, self).exists(path)
 
+    def _listing_hide_filter(self, path, full):
+        """
+        Returns a function that checks whether an entry listed in a
+        directory should be hidden, or None if nothing is hidden. The
+        directory itself must be shown, which it is when it can be listed,
+        so only the names of its entries need to be checked. Set full
+        if the entries are paths rather than names.
+
+        """
+        if self._hide_re is None:
+            return None
+        match = self._hide_re.match
+        if full:
+            return lambda entry: match(entry.rsplit('/', 1)[-1])
+        return match
+
     def listdir(self, path='./', **kwargs):
         path = normpath(path)
         entries = super(HideFS, self).listdir(path, **kwargs)
-        if kwargs.get('full'):
-            should_show = lambda entry: self._should_show(entry)
-        elif kwargs.get('absolute'):
-            should_show = lambda entry: self._should_show(entry.lstrip('/'))
-        else:
-            should_show = lambda entry: self._should_show(pathcombine(path, entry))
-        entries = [entry for entry in entries if should_show(entry)]
-        return entries
+        is_hidden = self._listing_hide_filter(path, kwargs.get('full') or kwargs.get('absolute'))
+        if is_hidden is None:
+            return entries
+        return list(itertools.ifilterfalse(is_hidden, entries))
 
     def ilistdir(self, path='./', **kwargs):
         path = normpath(path)
-        if kwargs.get('full'):
-            should_show = lambda entry: self._should_show(entry)
-        elif kwargs.get('absolute'):
-            should_show = lambda entry: self._should_show(entry.lstrip('/'))
-        else:
-            should_show = lambda entry: self._should_show(pathcombine(path, entry))
-        for entry in super(HideFS, self).ilistdir(path, **kwargs):
-            if should_show(entry):
-                yield path
+        entries = super(HideFS, self).ilistdir(path, **kwargs)
+        is_hidden = self._listing_hide_filter(path, kwargs.get('full') or kwargs.get('absolute'))
+        if is_hidden is None:
+            return entries
+        return itertools.ifilterfalse(is_hidden, entries)
 
     def ilistdirinfo(self, path='./', **kwargs):
         path = normpath(path)
-        if kwargs.get('full'):
-            should_show = lambda entry: self._should_show(entry)
-        elif kwargs.get('absolute'):
-            should_show = lambda entry: self._should_show(entry.lstrip('/'))
-        else:
-            should_show = lambda entry: self._should_show(pathcombine(path, entry))
-        for entry in super(HideFS, self).ilistdirinfo(path, **kwargs):
-            if should_show(entry[0]):
-                yield entry
+        entries = super(HideFS, self).ilistdirinfo(path, **kwargs)
+        is_hidden = self._listing_hide_filter(path, kwargs.get('full') or kwargs.get('absolute'))
+        if is_hidden is None:
+            return entries
+        return (entry for entry in entries if not is_hidden(entry[0]))
 
     @rewrite_errors
     def walk(self, path='/', wildcard=None, dir_wildcard=None, search='breadth', ignore_errors=False):
@@ -110,64 +166,104 @@ class HideFS(WrapFS):
                 else:
                     raise
 
-        if wildcard is None:
-            wildcard = lambda f: True
-        elif not callable(wildcard):
-            wildcard_re = re.compile(fnmatch.translate(wildcard))
-            wildcard = lambda fn: bool(wildcard_re.match(fn))
-
-        if dir_wildcard is None:
-            dir_wildcard = lambda f: True
-        elif not callable(dir_wildcard):
-            dir_wildcard_re = re.compile(fnmatch.translate(dir_wildcard))
-            dir_wildcard = lambda fn: bool(dir_wildcard_re.match(fn))
+        wildcard = _wildcard_function(wildcard)
+        dir_wildcard = _wildcard_function(dir_wildcard)
 
         if search == 'breadth':
 
-            dirs = [path]
-            while dirs:
-                current_path = dirs.pop()
-                paths = []
-                try:
-                    for filename in listdir(current_path):
-                        path = pathjoin(current_path, filename)
-                        if self.isdir(path):
-                            if dir_wildcard(path) and self._should_show(path):
-                                dirs.append(path)
-                        else:
-                            if wildcard(filename) and self._should_show(path):
-                                paths.append(filename)
-                except ResourceNotFoundError:
-                    # Could happen if another thread / process deletes something whilst we are walking
-                    pass
-
-                yield (current_path, paths)
+            for current_path, filenames in self._iwalk_breadth(path, wildcard, dir_wildcard, ignore_errors):
+                yield (current_path, list(filenames))
 
         elif search == 'depth':
 
-            def recurse(recurse_path):
+            def iter_subdirs(dir_path):
+                # The listings from this class are already filtered,
+                # so the entries don't need to be checked again here.
                 try:
-                    for path in listdir(recurse_path, wildcard=dir_wildcard, full=True, dirs_only=True):
-                        for p in recurse(path):
-                            yield p
+                    for subdir in self.ilistdir(dir_path, wildcard=dir_wildcard, full=True, dirs_only=True):
+                        yield subdir
                 except ResourceNotFoundError:
                     # Could happen if another thread / process deletes something whilst we are walking
                     pass
-
-                filenames = listdir(recurse_path, wildcard=wildcard, files_only=True)
-                filenames = [filename for filename in filenames if self._should_show(pathcombine(recurse_path, filename))]
-                yield (recurse_path, filenames)
-
-            for p in recurse(path):
-                yield p
+                except Exception:
+                    if not ignore_errors:
+                        raise
+
+            # Use a stack rather than recursion, so that results aren't passed
+            # up through a generator for each level. Each directory is yielded
+            # after all of its subdirectories.
+            stack = [(path, iter_subdirs(path))]
+            while stack:
+                current_path, subdirs = stack[-1]
+                for subdir in subdirs:
+                    stack.append((subdir, iter_subdirs(subdir)))
+                    break
+                else:
+                    stack.pop()
+                    yield (current_path, listdir(current_path, wildcard=wildcard, files_only=True))
 
         else:
             raise ValueError("Search should be 'breadth' or 'depth'")
 
+    def _iwalk_breadth(self, path, wildcard, dir_wildcard, ignore_errors):
+        """
+        Walks breadth first, generating (current_path, filenames) pairs,
+        where filenames is an iterator. Each directory is listed while its
+        filenames are consumed, so large directories are never held in
+        memory. The wildcards must be functions.
+
+        """
+
+        dirs = [path]
+        while dirs:
+            current_path = dirs.pop()
+            filenames = self._iter_filenames(current_path, wildcard, dir_wildcard, ignore_errors, dirs.append)
+            yield (current_path, filenames)
+            # Finish the listing if the filenames were not all consumed,
+            # so that all of the subdirectories are found.
+            for filename in filenames:
+                pass
+
+    def _iter_filenames(self, current_path, wildcard, dir_wildcard, ignore_errors, add_dir):
+        """
+        Generates the filenames in a directory for _iwalk_breadth,
+        and passes the paths of its subdirectories to add_dir.
+
+        """
+        try:
+            # The listing already leaves out hidden names, and the current
+            # path was either listed by its parent or is the starting path.
+            # Use st_mode from the info dicts to avoid isdir checks where possible.
+            for filename, info in self.ilistdirinfo(current_path):
+                path = pathjoin(current_path, filename)
+                if 'st_mode' in info:
+                    isdir = stat.S_ISDIR(info['st_mode'])
+                else:
+                    isdir = self.isdir(path)
+                if isdir:
+                    if dir_wildcard(path):
+                        add_dir(path)
+                else:
+                    if wildcard(filename):
+                        yield filename
+        except ResourceNotFoundError:
+            # Could happen if another thread / process deletes something whilst we are walking
+            pass
+        except Exception:
+            if not ignore_errors:
+                raise
+
     def walkfiles(self, path='/', wildcard=None, dir_wildcard=None, search='breadth', ignore_errors=False):
         # Bypass the WrapFS optimization because it avoids using
         # the "walk" method from this class.
-        items = self.walk(path, wildcard=wildcard, dir_wildcard=dir_wildcard, search=search, ignore_errors=ignore_errors)
+        if search == 'breadth':
+            # Generate the files while listing each directory,
+            # rather than building a list of them first.
+            wildcard = _wildcard_function(wildcard)
+            dir_wildcard = _wildcard_function(dir_wildcard)
+            items = self._iwalk_breadth(normpath(path), wildcard, dir_wildcard, ignore_errors)
+        else:
+            items = self.walk(path, wildcard=wildcard, dir_wildcard=dir_wildcard, search=search, ignore_errors=ignore_errors)
         for path, filenames in items:
             for filename in filenames:
                 yield pathjoin(path, filename)
@@ -192,9 +288,36 @@ class HidePathsFS(HideFS):
 
     """
 
-    def _should_hide(self, path):
-        path = path.lstrip('/')
-        return any(wildcard.match(path) for wildcard in self._hide_wildcards)
+    def _should_hide_uncached(self, path):
+        return self._hide_re.match(path.lstrip('/')) is not None
+
+    def _listing_hide_filter(self, path, full):
+        if self._hide_re is None:
+            return None
+        if full:
+            return self._should_hide
+        return lambda entry: self._should_hide(pathcombine(path, entry))
+
+
+def _wildcard_function(wildcard):
+    """Returns a function for a wildcard argument of walk."""
+    if wildcard is None:
+        return lambda f: True
+    elif not callable(wildcard):
+        return compile_wildcard(wildcard)
+    else:
+        return wildcard
+
+
+@memoize(max_size=256)
+def compile_wildcard(wildcard):
+    """
+    Returns a function that checks whether a filename matches a wildcard.
+    The functions are cached, because the same wildcards are used to walk
+    many times and translating them into regular expressions is slow.
+
+    """
+    return re.compile(fnmatch.translate(wildcard)).match
 
 
 hide_filenames = HideFS